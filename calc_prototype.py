@@ -30,10 +30,11 @@ def calc_prototype(opt, logger):
 
     # begin training
     model.iter = 0
+    source_iter = iter(datasets.source_train_loader)  # infinite sampler, never exhausts
     for epoch in range(opt.epochs):
-        for data_i in tqdm(datasets.target_train_loader):  
+        for data_i in tqdm(datasets.target_train_loader):
             model.iter += 1
-            source_data = datasets.source_train_loader.next()
+            source_data = next(source_iter)
             images = source_data['img'].to(device)
             labels = source_data['label'].to(device)
 
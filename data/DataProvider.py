@@ -7,38 +7,66 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.data as data
 
-class DataProvider():
-    def __init__(self, dataset, **kw):
-        self.args = kw
-        self.dataset = dataset
-        self.epoch = 0
-        self.DataLoader = None #data.DataLoader(self.dataset, **self.args)
-        self.iteration = 0
-        self.build()
-        pass
-    
-    def build(self):
-        self.DataLoader = data.DataLoader(self.dataset, **self.args)
-        self.DataLoader = enumerate(self.DataLoader)
+class InfiniteSampler(data.Sampler):
+    """Yields (optionally shuffled) dataset indices forever.
 
-    def __next__(self):
-        if self.DataLoader == None:
-            self.build()
-        
+    A DataLoader built on this sampler never exhausts its iterator, so
+    persistent workers are never torn down and rebuilt at epoch boundaries
+    the way they are when a fresh iterator is created on StopIteration.
+    """
+    def __init__(self, size, shuffle=True, seed=0):
+        self.size = size
+        self.shuffle = shuffle
+        self.seed = seed
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed)
+        while True:
+            if self.shuffle:
+                yield from torch.randperm(self.size, generator=g).tolist()
+            else:
+                yield from range(self.size)
+
+
+class CUDAPrefetcher():
+    """Wraps a loader and copies the next batch to the GPU on a side stream.
+
+    The H2D copy of batch N+1 is issued on a dedicated cuda stream while the
+    default stream is still busy computing on batch N, so the transfer time
+    is hidden behind compute (apex imagenet main_amp.py style). Falls back to
+    a plain synchronous iterator when cuda is unavailable.
+    """
+    def __init__(self, loader, device):
+        self.loader = iter(loader)
+        self.device = device
+        self.use_cuda = device.type == 'cuda'
+        self.stream = torch.cuda.Stream() if self.use_cuda else None
+        self.batch = None
+        self.preload()
+
+    def preload(self):
         try:
-            _, batch = self.DataLoader.__next__()
-            # img, label = batch
-            self.iteration += 1
-            return batch
-        
+            batch = self.loader.__next__()
         except StopIteration:
-            self.epoch += 1
-            self.iteration = 0
-            self.build()
-            _, batch = self.DataLoader.__next__()
-            # img, label = batch
-            return batch
-    next = __next__
+            self.batch = None
+            return
+        if not self.use_cuda:
+            self.batch = batch
+            return
+        with torch.cuda.stream(self.stream):
+            self.batch = {k: v.to(self.device, non_blocking=True) \
+                            if torch.is_tensor(v) else v for k, v in batch.items()}
 
-    def __iter__(self):
-        return self
\ No newline at end of file
+    def __next__(self):
+        batch = self.batch
+        if batch is None:
+            return None
+        if self.use_cuda:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            for v in batch.values():
+                if torch.is_tensor(v):
+                    v.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return batch
+    next = __next__
\ No newline at end of file
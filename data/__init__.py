@@ -1,12 +1,15 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import os
+import random
+import functools
 import importlib
 import numpy as np
 import torch.utils.data
 from data.base_dataset import BaseDataset
 from data.augmentations import *
-from data.DataProvider import DataProvider
+from data.DataProvider import InfiniteSampler
 
 def find_dataset_using_name(name):
     """Import the module "data/[dataset_name]_dataset.py".
@@ -51,6 +54,18 @@ def create_dataset(opt, logger):
     dataset = data_loader.load_data()
     return dataset
 
+def seed_worker(worker_id, base_seed):
+    """Seed each DataLoader worker differently.
+
+    Forked workers inherit the parent's numpy/random state, so without this
+    every worker would produce the same "random" augmentations.
+    """
+    seed = base_seed + worker_id
+    np.random.seed(seed)
+    random.seed(seed)
+    torch.manual_seed(seed)
+
+
 def get_composed_augmentations(opt):
     return Compose([RandomSized(opt.resize),
                     RandomCrop(opt.rcrop),
@@ -77,21 +92,37 @@ class CustomDatasetDataLoader():
         self.target_train[0]
 
         ## create train loader
-        self.source_train_loader = DataProvider(
-            dataset=self.source_train,
+        # cap workers at half the cores (the GPU feeding thread and the main
+        # process need cycles too) and keep the worker processes plus their
+        # cached dataset state alive across epochs instead of re-forking
+        num_workers = int(opt.num_workers)
+        if num_workers > 0:
+            num_workers = max(1, min(num_workers, (os.cpu_count() or num_workers) // 2))
+        worker_args = {'num_workers': num_workers}
+        if num_workers > 0:
+            worker_args['persistent_workers'] = True
+            worker_args['prefetch_factor'] = 2
+            worker_args['worker_init_fn'] = functools.partial(seed_worker, \
+                                                    base_seed=opt.seed)
+        worker_args['generator'] = torch.Generator().manual_seed(opt.seed)
+        # the source stream is consumed batch-by-batch alongside the target
+        # loader, so it samples forever instead of respawning per epoch
+        self.source_train_loader = torch.utils.data.DataLoader(
+            self.source_train,
             batch_size=opt.bs,
-            shuffle=not opt.noshuffle,
-            num_workers=int(opt.num_workers),
+            sampler=InfiniteSampler(len(self.source_train), \
+                        shuffle=not opt.noshuffle, seed=opt.seed),
             drop_last=True,
             pin_memory=True,
+            **worker_args,
         )
         self.target_train_loader = torch.utils.data.DataLoader(
             self.target_train,
             batch_size=opt.bs,
             shuffle=not opt.noshuffle,
-            num_workers=int(opt.num_workers),
             drop_last=not opt.no_droplast,
             pin_memory=True,
+            **worker_args,
         )
 
         # status == valid
@@ -110,9 +141,9 @@ class CustomDatasetDataLoader():
             self.target_valid,
             batch_size=opt.bs,
             shuffle=False,
-            num_workers=int(opt.num_workers),
             drop_last=False,
             pin_memory=True,
+            **worker_args,
         )
 
     def load_data(self):
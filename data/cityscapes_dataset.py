@@ -86,6 +86,7 @@ class Cityscapes_loader(BaseDataset):
         self.n_classes = opt.n_class
         self.img_size = (2048, 1024)
         self.mean = np.array(self.mean_rgb['cityscapes'])
+        self.mean_tensor = torch.from_numpy(self.mean.astype(np.float32)).view(-1, 1, 1)
         self.files = {}
         self.paired_files = {}
 
@@ -156,10 +157,8 @@ class Cityscapes_loader(BaseDataset):
         lbl = np.array(lbl, dtype=np.uint8)
         lbl = self.encode_segmap(np.array(lbl, dtype=np.uint8)) # 将标签转换为合法值
 
-        img_full = img.copy().astype(np.float64)
-        img_full -= self.mean    # cityscapes 没有减少
-        img_full = img_full.astype(float) / 255.0  #归一化
-        img_full = img_full.transpose(2, 0, 1)  #通道转换 NHWC -> NCHW
+        img_full = torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1)  #通道转换 NHWC -> NCHW
+        img_full = img_full.float().sub_(self.mean_tensor).div_(255.0)  #归一化
 
         lp, lpsoft, weak_params = None, None, None
         if self.split == 'train' and self.opt.used_save_pseudo:
@@ -185,7 +184,9 @@ class Cityscapes_loader(BaseDataset):
         img, lbl_, lp = self.transform(img, lbl, lp)
                 
         input_dict['img'] = img
-        input_dict['img_full'] = torch.from_numpy(img_full).float()  # 归一化+通道转换后数据
+        # fp16 halves the H2D bandwidth of the full-resolution image; it is
+        # only consumed for pseudo-label rectification and upcast on the GPU
+        input_dict['img_full'] = img_full.to(torch.float16)  # 归一化+通道转换后数据
         input_dict['label'] = lbl_
         input_dict['lp'] = lp
         input_dict['lpsoft'] = lpsoft
@@ -201,12 +202,12 @@ class Cityscapes_loader(BaseDataset):
         :param img:
         :param lbl:
         """
-        img = np.array(img)
+        img = np.asarray(img, dtype=np.uint8)
         # img = img[:, :, ::-1]  # RGB -> BGR
-        img = img.astype(np.float64)
-        img -= self.mean
-        img = img.astype(float) / 255.0
-        img = img.transpose(2, 0, 1) # NHWC -> NCHW
+        # normalize with in-place torch ops on float32 instead of the old
+        # two-pass float64 numpy pipeline, which copied each sample twice
+        img = torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1) # NHWC -> NCHW
+        img = img.float().sub_(self.mean_tensor).div_(255.0)
 
         classes = np.unique(lbl)
         lbl = np.array(lbl)
@@ -217,7 +218,6 @@ class Cityscapes_loader(BaseDataset):
             print("after det", classes, np.unique(lbl))
             raise ValueError("Segmentation map contained invalid class values")
 
-        img = torch.from_numpy(img).float()
         lbl = torch.from_numpy(lbl).long()
 
         if lp is not None:
@@ -58,6 +58,7 @@ class GTA5_loader(BaseDataset):
         self.img_size = (1914, 1052)
 
         self.mean = [0.0, 0.0, 0.0] #TODO:  calculating the mean value of rgb channels on GTA5
+        self.mean_tensor = torch.tensor(self.mean, dtype=torch.float32).view(-1, 1, 1)
         self.image_base_path = os.path.join(self.root, 'images')
         self.label_base_path = os.path.join(self.root, 'labels')
         splits = io.loadmat(os.path.join(self.root, 'split.mat'))
@@ -160,12 +161,12 @@ class GTA5_loader(BaseDataset):
 
         img, lbl
         """
-        img = np.array(img)
+        img = np.asarray(img, dtype=np.uint8)
         # img = img[:, :, ::-1] # RGB -> BGR
-        img = img.astype(np.float64)
-        img -= self.mean
-        img = img.astype(float) / 255.0
-        img = img.transpose(2, 0, 1)
+        # normalize with in-place torch ops on float32 instead of the old
+        # two-pass float64 numpy pipeline, which copied each sample twice
+        img = torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1)
+        img = img.float().sub_(self.mean_tensor).div_(255.0)
 
         classes = np.unique(lbl)
         lbl = np.array(lbl)
@@ -180,7 +181,6 @@ class GTA5_loader(BaseDataset):
             print("after det", classes, np.unique(lbl))
             raise ValueError("Segmentation map contained invalid class values")
         
-        img = torch.from_numpy(img).float()
         lbl = torch.from_numpy(lbl).long()
 
         return img, lbl
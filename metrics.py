@@ -26,6 +26,11 @@ class runningScore(object):
                 lt.flatten(), lp.flatten(), self.n_classes
             )
 
+    def update_confusion_matrix(self, hist):
+        """Accumulate an already-computed (n_classes, n_classes) histogram,
+        e.g. one built on GPU with torch.bincount."""
+        self.confusion_matrix += hist
+
     def get_scores(self):
         """Returns accuracy score evaluation result.
             - overall accuracy
@@ -106,6 +106,10 @@ class CustomModel():
                                                 whether_DP=True)
 
 
+        # mixed precision: forwards run under autocast, backwards through the
+        # shared GradScaler; disabled transparently on CPU-only machines
+        self.scaler = torch.cuda.amp.GradScaler(enabled=torch.cuda.is_available())
+
         self.adv_source_label = 0
         self.adv_target_label = 1
         if self.opt.gan == 'Vanilla':
@@ -155,115 +159,124 @@ class CustomModel():
     def step_adv(self, source_x, source_label, target_x, source_imageS, source_params):
         for param in self.net_D.parameters():
             param.requires_grad = False
-        self.BaseOpti.zero_grad()
-        
-        if self.opt.S_pseudo_src > 0:
-            source_output = self.BaseNet_DP(source_imageS)
-            source_label_d4 = F.interpolate(source_label.unsqueeze(1).float(), size=source_output['out'].size()[2:])
-            source_labelS = self.label_strong_T(source_label_d4.clone().float(), source_params, padding=250, scale=4).to(torch.int64)
-            loss_ = cross_entropy2d(input=source_output['out'], target=source_labelS.squeeze(1))
-            loss_GTA = loss_ * self.opt.S_pseudo_src
-            source_outputUp = F.interpolate(source_output['out'], size=source_x.size()[2:], mode='bilinear', align_corners=True)
-        else:
-            source_output = self.BaseNet_DP(source_x, ssl=True)
-            source_outputUp = F.interpolate(source_output['out'], size=source_x.size()[2:], mode='bilinear', align_corners=True)
-
-            loss_GTA = cross_entropy2d(input=source_outputUp, target=source_label, size_average=True, reduction='mean')
-
-        target_output = self.BaseNet_DP(target_x, ssl=True)
-        target_outputUp = F.interpolate(target_output['out'], size=target_x.size()[2:], mode='bilinear', align_corners=True)
-        target_D_out = self.net_D_DP(F.softmax(target_outputUp, dim=1))
-        loss_adv_G = self.bceloss(target_D_out, torch.FloatTensor(target_D_out.data.size()).fill_(self.adv_source_label).to(target_D_out.device)) * self.opt.adv
-        loss_G = loss_adv_G + loss_GTA
-        loss_G.backward()
-        self.BaseOpti.step()
+        self.BaseOpti.zero_grad(set_to_none=True)
+
+        with torch.cuda.amp.autocast(enabled=self.scaler.is_enabled()):
+            if self.opt.S_pseudo_src > 0:
+                source_output = self.BaseNet_DP(source_imageS)
+                source_label_d4 = F.interpolate(source_label.unsqueeze(1).float(), size=source_output['out'].size()[2:])
+                source_labelS = self.label_strong_T(source_label_d4.clone().float(), source_params, padding=250, scale=4).to(torch.int64)
+                loss_ = cross_entropy2d(input=source_output['out'], target=source_labelS.squeeze(1))
+                loss_GTA = loss_ * self.opt.S_pseudo_src
+                source_outputUp = F.interpolate(source_output['out'], size=source_x.size()[2:], mode='bilinear', align_corners=True)
+            else:
+                source_output = self.BaseNet_DP(source_x, ssl=True)
+                source_outputUp = F.interpolate(source_output['out'], size=source_x.size()[2:], mode='bilinear', align_corners=True)
+
+                loss_GTA = cross_entropy2d(input=source_outputUp, target=source_label, size_average=True, reduction='mean')
+
+            target_output = self.BaseNet_DP(target_x, ssl=True)
+            target_outputUp = F.interpolate(target_output['out'], size=target_x.size()[2:], mode='bilinear', align_corners=True)
+            target_D_out = self.net_D_DP(F.softmax(target_outputUp, dim=1))
+            loss_adv_G = self.bceloss(target_D_out, torch.zeros_like(target_D_out).fill_(self.adv_source_label)) * self.opt.adv
+            loss_G = loss_adv_G + loss_GTA
+        self.scaler.scale(loss_G).backward()
+        self.scaler.step(self.BaseOpti)
 
         for param in self.net_D.parameters():
             param.requires_grad = True
-        self.optimizer_D.zero_grad()
-        source_D_out = self.net_D_DP(F.softmax(source_outputUp.detach(), dim=1))
-        target_D_out = self.net_D_DP(F.softmax(target_outputUp.detach(), dim=1))
-        loss_D = self.bceloss(source_D_out, torch.FloatTensor(source_D_out.data.size()).fill_(self.adv_source_label).to(source_D_out.device)) + \
-                    self.bceloss(target_D_out, torch.FloatTensor(target_D_out.data.size()).fill_(self.adv_target_label).to(target_D_out.device))
-        loss_D.backward()
-        self.optimizer_D.step()
-
-        return loss_GTA.item(), loss_adv_G.item(), loss_D.item()
-
-    def step(self, source_x, source_label, target_x, target_imageS=None, target_params=None, target_lp=None, 
-            target_lpsoft=None, target_image_full=None, target_weak_params=None):
-
-        source_out = self.BaseNet_DP(source_x, ssl=True)
-        source_outputUp = F.interpolate(source_out['out'], size=source_x.size()[2:], mode='bilinear', align_corners=True)
-
-        loss_GTA = cross_entropy2d(input=source_outputUp, target=source_label)
-        loss_GTA.backward()        
-
-        if self.opt.proto_rectify:
-            threshold_arg = F.interpolate(target_lpsoft, scale_factor=0.25, mode='bilinear', align_corners=True)
-        else:
-            threshold_arg = F.interpolate(target_lp.unsqueeze(1).float(), scale_factor=0.25).long()
-
-        if self.opt.ema:
-            ema_input = target_image_full
-            with torch.no_grad():
-                ema_out = self.BaseNet_ema_DP(ema_input)
-            ema_out['feat'] = F.interpolate(ema_out['feat'], size=(int(ema_input.shape[2]/4), int(ema_input.shape[3]/4)), mode='bilinear', align_corners=True)
-            ema_out['out'] = F.interpolate(ema_out['out'], size=(int(ema_input.shape[2]/4), int(ema_input.shape[3]/4)), mode='bilinear', align_corners=True)
-
-        target_out = self.BaseNet_DP(target_imageS) if self.opt.S_pseudo > 0 else self.BaseNet_DP(target_x)
-        target_out['out'] = F.interpolate(target_out['out'], size=threshold_arg.shape[2:], mode='bilinear', align_corners=True)
-        target_out['feat'] = F.interpolate(target_out['feat'], size=threshold_arg.shape[2:], mode='bilinear', align_corners=True)
-
-        loss = torch.Tensor([0]).to(self.default_gpu)
-        batch, _, w, h = threshold_arg.shape
-        if self.opt.proto_rectify:
-            weights = self.get_prototype_weight(ema_out['feat'], target_weak_params=target_weak_params)
-            rectified = weights * threshold_arg
-            threshold_arg = rectified.max(1, keepdim=True)[1]
-            rectified = rectified / rectified.sum(1, keepdim=True)
-            argmax = rectified.max(1, keepdim=True)[0]
-            threshold_arg[argmax < self.opt.train_thred] = 250
-        if self.opt.S_pseudo > 0:
-            threshold_argS = self.label_strong_T(threshold_arg.clone().float(), target_params, padding=250, scale=4).to(torch.int64)
-            cluster_argS = self.label_strong_T(cluster_arg.clone().float(), target_params, padding=250, scale=4).to(torch.int64)
-            threshold_arg = threshold_argS
-
-        loss_CTS = cross_entropy2d(input=target_out['out'], target=threshold_arg.reshape([batch, w, h]))
-
-        if self.opt.rce:
-            rce = self.rce(target_out['out'], threshold_arg.reshape([batch, w, h]).clone())
-            loss_CTS = self.opt.rce_alpha * loss_CTS + self.opt.rce_beta * rce
-
-        if self.opt.regular_w > 0:
-            regular_loss = self.regular_loss(target_out['out'])
-            loss_CTS = loss_CTS + regular_loss * self.opt.regular_w
-
-        cluster_argS = None
-        loss_consist = torch.Tensor([0]).to(self.default_gpu)
-        if self.opt.proto_consistW > 0:
-            ema2weak_feat = self.full2weak(ema_out['feat'], target_weak_params)         #N*256*H*W
-            ema2weak_feat_proto_distance = self.feat_prototype_distance(ema2weak_feat)  #N*19*H*W
-            ema2strong_feat_proto_distance = self.label_strong_T(ema2weak_feat_proto_distance, target_params, padding=250, scale=4)
-            mask = (ema2strong_feat_proto_distance != 250).float()
-            teacher = F.softmax(-ema2strong_feat_proto_distance * self.opt.proto_temperature, dim=1)
-
-            targetS_out = target_out if self.opt.S_pseudo > 0 else self.BaseNet_DP(target_imageS)
-            targetS_out['out'] = F.interpolate(targetS_out['out'], size=threshold_arg.shape[2:], mode='bilinear', align_corners=True)
-            targetS_out['feat'] = F.interpolate(targetS_out['feat'], size=threshold_arg.shape[2:], mode='bilinear', align_corners=True)
-
-            prototype_tmp = self.objective_vectors.expand(4, -1, -1)  #gpu memory limitation
-            strong_feat_proto_distance = self.feat_prototype_distance_DP(targetS_out['feat'], prototype_tmp, self.class_numbers)
-            student = F.log_softmax(-strong_feat_proto_distance * self.opt.proto_temperature, dim=1)
-
-            loss_consist = F.kl_div(student, teacher, reduction='none')
-            loss_consist = (loss_consist * mask).sum() / mask.sum()
-            loss = loss + self.opt.proto_consistW * loss_consist
-
-        loss = loss + loss_CTS
-        loss.backward()
-        self.BaseOpti.step()
-        self.BaseOpti.zero_grad()
+        self.optimizer_D.zero_grad(set_to_none=True)
+        with torch.cuda.amp.autocast(enabled=self.scaler.is_enabled()):
+            source_D_out = self.net_D_DP(F.softmax(source_outputUp.detach(), dim=1))
+            target_D_out = self.net_D_DP(F.softmax(target_outputUp.detach(), dim=1))
+            loss_D = self.bceloss(source_D_out, torch.zeros_like(source_D_out).fill_(self.adv_source_label)) + \
+                        self.bceloss(target_D_out, torch.zeros_like(target_D_out).fill_(self.adv_target_label))
+        self.scaler.scale(loss_D).backward()
+        self.scaler.step(self.optimizer_D)
+        self.scaler.update()
+
+        # return detached device scalars; .item() here would force a
+        # stream sync every iteration (the caller syncs once per log interval)
+        return loss_GTA.detach(), loss_adv_G.detach(), loss_D.detach()
+
+    def step(self, source_x, source_label, target_x, target_imageS=None, target_params=None, target_lp=None,
+            target_lpsoft=None, target_image_full=None, target_weak_params=None, do_source=True):
+
+        if do_source:
+            with torch.cuda.amp.autocast(enabled=self.scaler.is_enabled()):
+                source_out = self.BaseNet_DP(source_x, ssl=True)
+                source_outputUp = F.interpolate(source_out['out'], size=source_x.size()[2:], mode='bilinear', align_corners=True)
+
+                loss_GTA = cross_entropy2d(input=source_outputUp, target=source_label)
+            self.scaler.scale(loss_GTA).backward()
+
+        with torch.cuda.amp.autocast(enabled=self.scaler.is_enabled()):
+            if self.opt.proto_rectify:
+                threshold_arg = F.interpolate(target_lpsoft, scale_factor=0.25, mode='bilinear', align_corners=True)
+            else:
+                threshold_arg = F.interpolate(target_lp.unsqueeze(1).float(), scale_factor=0.25).long()
+
+            if self.opt.ema:
+                ema_input = target_image_full.float()  # upcast the fp16 cached image on device
+                with torch.no_grad():
+                    ema_out = self.BaseNet_ema_DP(ema_input)
+                ema_out['feat'] = F.interpolate(ema_out['feat'], size=(int(ema_input.shape[2]/4), int(ema_input.shape[3]/4)), mode='bilinear', align_corners=True)
+                ema_out['out'] = F.interpolate(ema_out['out'], size=(int(ema_input.shape[2]/4), int(ema_input.shape[3]/4)), mode='bilinear', align_corners=True)
+
+            target_out = self.BaseNet_DP(target_imageS) if self.opt.S_pseudo > 0 else self.BaseNet_DP(target_x)
+            target_out['out'] = F.interpolate(target_out['out'], size=threshold_arg.shape[2:], mode='bilinear', align_corners=True)
+            target_out['feat'] = F.interpolate(target_out['feat'], size=threshold_arg.shape[2:], mode='bilinear', align_corners=True)
+
+            loss = torch.Tensor([0]).to(self.default_gpu)
+            batch, _, w, h = threshold_arg.shape
+            if self.opt.proto_rectify:
+                weights = self.get_prototype_weight(ema_out['feat'], target_weak_params=target_weak_params)
+                rectified = weights * threshold_arg
+                threshold_arg = rectified.max(1, keepdim=True)[1]
+                rectified = rectified / rectified.sum(1, keepdim=True)
+                argmax = rectified.max(1, keepdim=True)[0]
+                threshold_arg[argmax < self.opt.train_thred] = 250
+            if self.opt.S_pseudo > 0:
+                threshold_argS = self.label_strong_T(threshold_arg.clone().float(), target_params, padding=250, scale=4).to(torch.int64)
+                cluster_argS = self.label_strong_T(cluster_arg.clone().float(), target_params, padding=250, scale=4).to(torch.int64)
+                threshold_arg = threshold_argS
+
+            loss_CTS = cross_entropy2d(input=target_out['out'], target=threshold_arg.reshape([batch, w, h]))
+
+            if self.opt.rce:
+                rce = self.rce(target_out['out'], threshold_arg.reshape([batch, w, h]).clone())
+                loss_CTS = self.opt.rce_alpha * loss_CTS + self.opt.rce_beta * rce
+
+            if self.opt.regular_w > 0:
+                regular_loss = self.regular_loss(target_out['out'])
+                loss_CTS = loss_CTS + regular_loss * self.opt.regular_w
+
+            cluster_argS = None
+            loss_consist = torch.Tensor([0]).to(self.default_gpu)
+            if self.opt.proto_consistW > 0:
+                ema2weak_feat = self.full2weak(ema_out['feat'], target_weak_params)         #N*256*H*W
+                ema2weak_feat_proto_distance = self.feat_prototype_distance(ema2weak_feat)  #N*19*H*W
+                ema2strong_feat_proto_distance = self.label_strong_T(ema2weak_feat_proto_distance, target_params, padding=250, scale=4)
+                mask = (ema2strong_feat_proto_distance != 250).float()
+                teacher = F.softmax(-ema2strong_feat_proto_distance * self.opt.proto_temperature, dim=1)
+
+                targetS_out = target_out if self.opt.S_pseudo > 0 else self.BaseNet_DP(target_imageS)
+                targetS_out['out'] = F.interpolate(targetS_out['out'], size=threshold_arg.shape[2:], mode='bilinear', align_corners=True)
+                targetS_out['feat'] = F.interpolate(targetS_out['feat'], size=threshold_arg.shape[2:], mode='bilinear', align_corners=True)
+
+                prototype_tmp = self.objective_vectors.expand(4, -1, -1)  #gpu memory limitation
+                strong_feat_proto_distance = self.feat_prototype_distance_DP(targetS_out['feat'], prototype_tmp, self.class_numbers)
+                student = F.log_softmax(-strong_feat_proto_distance * self.opt.proto_temperature, dim=1)
+
+                loss_consist = F.kl_div(student, teacher, reduction='none')
+                loss_consist = (loss_consist * mask).sum() / mask.sum()
+                loss = loss + self.opt.proto_consistW * loss_consist
+
+            loss = loss + loss_CTS
+        self.scaler.scale(loss).backward()
+        self.scaler.step(self.BaseOpti)
+        self.scaler.update()
+        self.BaseOpti.zero_grad(set_to_none=True)
 
         if self.opt.moving_prototype: #update prototype
             ema_vectors, ema_ids = self.calculate_mean_vector(ema_out['feat'].detach(), ema_out['out'].detach())
@@ -276,7 +289,7 @@ class CustomModel():
             for buffer_q, buffer_k in zip(self.BaseNet.buffers(), self.BaseNet_ema.buffers()):
                 buffer_k.data = buffer_q.data.clone()
 
-        return loss.item(), loss_CTS.item(), loss_consist.item()
+        return loss.detach(), loss_CTS.detach(), loss_consist.detach()
 
     def regular_loss(self, activation):
         logp = F.log_softmax(activation, dim=1)
@@ -299,40 +312,43 @@ class CustomModel():
 
     def step_distillation(self, source_x, source_label, target_x, target_imageS=None, target_params=None, target_lp=None):
 
-        source_out = self.BaseNet_DP(source_x, ssl=True)
-        source_outputUp = F.interpolate(source_out['out'], size=source_x.size()[2:], mode='bilinear', align_corners=True)
-        loss_GTA = cross_entropy2d(input=source_outputUp, target=source_label)
-        loss_GTA.backward()
+        with torch.cuda.amp.autocast(enabled=self.scaler.is_enabled()):
+            source_out = self.BaseNet_DP(source_x, ssl=True)
+            source_outputUp = F.interpolate(source_out['out'], size=source_x.size()[2:], mode='bilinear', align_corners=True)
+            loss_GTA = cross_entropy2d(input=source_outputUp, target=source_label)
+        self.scaler.scale(loss_GTA).backward()
 
-        threshold_arg = F.interpolate(target_lp.unsqueeze(1).float(), scale_factor=0.25).long()
-        if self.opt.S_pseudo > 0:
-            threshold_arg = self.label_strong_T(threshold_arg.clone().float(), target_params, padding=250, scale=4).to(torch.int64)
-            target_out = self.BaseNet_DP(target_imageS)
-        else:
-            target_out = self.BaseNet_DP(target_x)
-        target_out['out'] = F.interpolate(target_out['out'], size=threshold_arg.shape[2:], mode='bilinear', align_corners=True)
-        batch, _, w, h = threshold_arg.shape
-        loss = cross_entropy2d(input=target_out['out'], target=threshold_arg.reshape([batch, w, h]), size_average=True, reduction='mean')
-        if self.opt.rce:
-            rce = self.rce(target_out['out'], threshold_arg.reshape([batch, w, h]).clone())
-            loss = self.opt.rce_alpha * loss + self.opt.rce_beta * rce
-
-        if self.opt.distillation > 0:
-            student = F.softmax(target_out['out'], dim=1)
-            with torch.no_grad():
-                teacher_out = self.teacher_DP(target_imageS)
-                teacher_out['out'] = F.interpolate(teacher_out['out'], size=threshold_arg.shape[2:], mode='bilinear', align_corners=True)
-                teacher = F.softmax(teacher_out['out'], dim=1)
-
-            loss_kd = F.kl_div(student, teacher, reduction='none')
-            mask = (teacher != 250).float()
-            loss_kd = (loss_kd * mask).sum() / mask.sum()
-            loss = loss + self.opt.distillation * loss_kd
-
-        loss.backward()
-        self.BaseOpti.step()
-        self.BaseOpti.zero_grad()
-        return loss_GTA.item(), loss.item()
+        with torch.cuda.amp.autocast(enabled=self.scaler.is_enabled()):
+            threshold_arg = F.interpolate(target_lp.unsqueeze(1).float(), scale_factor=0.25).long()
+            if self.opt.S_pseudo > 0:
+                threshold_arg = self.label_strong_T(threshold_arg.clone().float(), target_params, padding=250, scale=4).to(torch.int64)
+                target_out = self.BaseNet_DP(target_imageS)
+            else:
+                target_out = self.BaseNet_DP(target_x)
+            target_out['out'] = F.interpolate(target_out['out'], size=threshold_arg.shape[2:], mode='bilinear', align_corners=True)
+            batch, _, w, h = threshold_arg.shape
+            loss = cross_entropy2d(input=target_out['out'], target=threshold_arg.reshape([batch, w, h]), size_average=True, reduction='mean')
+            if self.opt.rce:
+                rce = self.rce(target_out['out'], threshold_arg.reshape([batch, w, h]).clone())
+                loss = self.opt.rce_alpha * loss + self.opt.rce_beta * rce
+
+            if self.opt.distillation > 0:
+                student = F.softmax(target_out['out'], dim=1)
+                with torch.no_grad():
+                    teacher_out = self.teacher_DP(target_imageS)
+                    teacher_out['out'] = F.interpolate(teacher_out['out'], size=threshold_arg.shape[2:], mode='bilinear', align_corners=True)
+                    teacher = F.softmax(teacher_out['out'], dim=1)
+
+                loss_kd = F.kl_div(student, teacher, reduction='none')
+                mask = (teacher != 250).float()
+                loss_kd = (loss_kd * mask).sum() / mask.sum()
+                loss = loss + self.opt.distillation * loss_kd
+
+        self.scaler.scale(loss).backward()
+        self.scaler.step(self.BaseOpti)
+        self.scaler.update()
+        self.BaseOpti.zero_grad(set_to_none=True)
+        return loss_GTA.detach(), loss.detach()
 
     def full2weak(self, feat, target_weak_params):
         tmp = []
@@ -404,7 +420,9 @@ class CustomModel():
     
     def optimizer_zerograd(self):
         for optimizer in self.optimizers:
-            optimizer.zero_grad()
+            # set_to_none skips the full-model memset; grads are recreated
+            # lazily by the next backward
+            optimizer.zero_grad(set_to_none=True)
     
 
     def init_device(self, net, gpu_id=None, whether_DP=False):
@@ -412,7 +430,9 @@ class CustomModel():
         device = torch.device("cuda:{}".format(gpu_id) if torch.cuda.is_available() else 'cpu')
         net = net.to(device)
         # if torch.cuda.is_available():
-        if whether_DP:
+        if whether_DP and torch.cuda.device_count() > 1:
+            # on a single GPU DataParallel only adds per-forward
+            # scatter/replicate/gather overhead, so call the module directly
             #net = DataParallelWithCallback(net, device_ids=[0])
             net = DataParallelWithCallback(net, device_ids=range(torch.cuda.device_count()))
         return net
@@ -74,6 +74,8 @@ def parser_(parser):
 
     parser.add_argument('--S_pseudo', type=float, default=0.0, \
                             help='loss weight of pseudo label for strong augmentation')
+    parser.add_argument('--source_every', type=int, default=1, \
+                            help='run the source branch every k iters in stage1')
 
     #print
     parser.add_argument('--print_interval', type=int, default=20, help='print loss')
@@ -81,6 +83,8 @@ def parser_(parser):
 
     parser.add_argument('--noshuffle', action='store_true', help='do not use shuffle')
     parser.add_argument('--noaug', action='store_true', help='do not use data augmentation')
+    parser.add_argument('--shm_cache', action='store_true', \
+                            help='stage pseudo labels into /dev/shm before training')
 
     parser.add_argument('--proto_rectify', action='store_true')
     parser.add_argument('--proto_temperature', type=float, default=1.0)
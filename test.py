@@ -63,8 +63,8 @@ def validate(valid_loader, device, model, running_metrics_val):
         #outputs = F.interpolate(sm(outs['out']), size=images_val.size()[2:], mode='bilinear', align_corners=True)
         outputs = F.interpolate(outs['out'], size=images_val.size()[2:], mode='bilinear', align_corners=True)
 
-        pred = outputs.data.max(1)[1].cpu().numpy()
-        gt = labels_val.data.cpu().numpy()
+        pred = outputs.argmax(1).cpu().numpy()
+        gt = labels_val.cpu().numpy()
         running_metrics_val.update(gt, pred)
 
 def get_logger(logdir):
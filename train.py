@@ -4,6 +4,7 @@
 import os
 import sys
 import time
+import atexit
 import torch
 import random
 import argparse
@@ -14,9 +15,25 @@ from parser_train import parser_, relative_path_to_absolute_path
 
 from tqdm import tqdm
 from data import create_dataset
-from utils import get_logger
+from data.DataProvider import CUDAPrefetcher
+from utils import get_logger, stage_to_shm
 from models import adaptation_modelv2
 from metrics import runningScore, averageMeter
+from concurrent.futures import ThreadPoolExecutor
+
+# checkpoints are serialized on a single background thread so training
+# resumes as soon as the state dict has been copied off the GPU
+_save_pool = ThreadPoolExecutor(max_workers=1)
+atexit.register(_save_pool.shutdown, wait=True)
+
+def state_to_cpu(value):
+    if torch.is_tensor(value):
+        return value.cpu()
+    if isinstance(value, dict):
+        return {k: state_to_cpu(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(state_to_cpu(v) for v in value)
+    return value
 
 def set_seed(opt):
     torch.manual_seed(opt.seed)
@@ -27,6 +44,16 @@ def set_seed(opt):
 def train(opt, logger):
     set_seed(opt)
 
+    # stage the hottest per-epoch inputs (pseudo labels) into tmpfs so every
+    # epoch reads them at memory speed instead of going back to disk
+    if opt.shm_cache and opt.used_save_pseudo:
+        if opt.proto_rectify:
+            opt.path_soft = stage_to_shm(opt.path_soft)
+        else:
+            opt.path_LP = stage_to_shm(opt.path_LP)
+        logger.info('pseudo labels staged to {}'.format(
+                opt.path_soft if opt.proto_rectify else opt.path_LP))
+
     # create dataset
     datasets = create_dataset(opt, logger)
     
@@ -49,23 +76,27 @@ def train(opt, logger):
     model.iter = 0
     start_epoch = 0
     device = torch.device("cuda:0" if torch.cuda.is_available() else 'cpu')
+    source_prefetcher = CUDAPrefetcher(datasets.source_train_loader, device)
+    loss_sums = {}
+    loss_count = 0
     for epoch in range(start_epoch, opt.epochs):
-        for data_i in datasets.target_train_loader:
-            # load data
+        target_prefetcher = CUDAPrefetcher(datasets.target_train_loader, device)
+        data_i = target_prefetcher.next()
+        while data_i is not None:
+            # load data, already moved to device by the prefetcher
             timestamp = time.time()
-            target_image = data_i['img'].to(device)
-            target_imageS = data_i['img_strong'].to(device)
+            target_image = data_i['img']
+            target_imageS = data_i['img_strong']
             target_params = data_i['params']
-            target_image_full = data_i['img_full'].to(device)
+            target_image_full = data_i['img_full'].contiguous(memory_format=torch.channels_last)
             target_weak_params = data_i['weak_params']
-            target_lp = data_i['lp'].to(device) if 'lp' in data_i.keys() else None
-            target_lpsoft = data_i['lpsoft'].to(device) \
-                                if 'lpsoft' in data_i.keys() else None
-            
-            source_data = datasets.source_train_loader.next()
-            images = source_data['img'].to(device)
-            labels = source_data['label'].to(device)
-            source_imageS = source_data['img_strong'].to(device)
+            target_lp = data_i['lp'] if 'lp' in data_i.keys() else None
+            target_lpsoft = data_i['lpsoft'] if 'lpsoft' in data_i.keys() else None
+
+            source_data = source_prefetcher.next()
+            images = source_data['img']
+            labels = source_data['label']
+            source_imageS = source_data['img_strong']
             source_params = source_data['params']
 
             # infer result
@@ -78,37 +109,57 @@ def train(opt, logger):
             if opt.stage == 'warm_up':
                 loss_GTA, loss_G, loss_D = model.step_adv(images, labels,\
                                             target_image, source_imageS, source_params)
+                step_losses = {'loss_GTA': loss_GTA, 'loss_G': loss_G, 'loss_D': loss_D}
             elif opt.stage == 'stage1':
+                # the source forward/backward can be amortized over several
+                # iterations; the target losses still run every step
+                do_source = (model.iter % opt.source_every) == 0
                 loss, loss_CTS, loss_consist = model.step(images, labels, \
                                         target_image, target_imageS, target_params, target_lp,
-                                        target_lpsoft, target_image_full, target_weak_params)
+                                        target_lpsoft, target_image_full, target_weak_params,
+                                        do_source=do_source)
+                step_losses = {'loss': loss, 'loss_CTS': loss_CTS, 'loss_consist': loss_consist}
             else:
                 loss_GTA, loss = model.step_distillation(images, labels, target_image, \
                                                 target_imageS, target_params, target_lp)
+                step_losses = {'loss_GTA': loss_GTA, 'loss': loss}
+
+            # accumulate losses on device; formatting a CUDA scalar would
+            # force a sync every iteration, so only read them at print time
+            for _name, _loss in step_losses.items():
+                loss_sums[_name] = loss_sums.get(_name, 0) + _loss
+            loss_count += 1
 
             # record result
             model.iter += 1
             infer_time_meter.update(time.time() - start_ts) # 计算模型推断的时间
             loader_time_meter.update(start_ts-timestamp)
             if (model.iter + 1) % opt.print_interval == 0:
+                loss_avgs = {_name: float(_sum / loss_count) \
+                                for _name, _sum in loss_sums.items()}
+                loss_sums = {}
+                loss_count = 0
                 if opt.stage == 'warm_up':
                     fmt_str = "Epochs [{:d}/{:d}] Iter [{:d}/{:d}]  loss_GTA: {:.4f}  \
                                loss_G: {:.4f}  loss_D: {:.4f} infertime/Image: {:.4f} imgloadtime/Image: {:.4f}"
                     print_str = fmt_str.format(epoch+1, opt.epochs, model.iter + 1, \
-                                    opt.train_iters, loss_GTA, loss_G, loss_D, \
+                                    opt.train_iters, loss_avgs['loss_GTA'], \
+                                    loss_avgs['loss_G'], loss_avgs['loss_D'], \
                                     infer_time_meter.avg / opt.bs, loader_time_meter.avg / opt.bs)
                 elif opt.stage == 'stage1':
                     fmt_str = "Epochs [{:d}/{:d}] Iter [{:d}/{:d}]  loss: {:.4f}  \
                                loss_CTS: {:.4f}  loss_consist: {:.4f} infertime/Image: {:.4f} \
                                imgloadtime/Image: {:.4f}"
                     print_str = fmt_str.format(epoch+1, opt.epochs, model.iter + 1,\
-                                 opt.train_iters, loss, loss_CTS, loss_consist, \
+                                 opt.train_iters, loss_avgs['loss'], loss_avgs['loss_CTS'], \
+                                 loss_avgs['loss_consist'], \
                                  infer_time_meter.avg / opt.bs, loader_time_meter.avg / opt.bs)
                 else:
                     fmt_str = "Epochs [{:d}/{:d}] Iter [{:d}/{:d}]  loss_GTA: {:.4f}  \
                                loss: {:.4f} infertime/Image: {:.4f} imgloadtime/Image: {:.4f}"
                     print_str = fmt_str.format(epoch+1, opt.epochs, model.iter + 1, \
-                                opt.train_iters, loss_GTA, loss, infer_time_meter.avg / opt.bs, \
+                                opt.train_iters, loss_avgs['loss_GTA'], loss_avgs['loss'], \
+                                infer_time_meter.avg / opt.bs, \
                                 loader_time_meter.avg / opt.bs)
                 print(print_str)
                 logger.info(print_str)
@@ -122,6 +173,7 @@ def train(opt, logger):
                 logger.info('Best iou until now is {}'.format(model.best_iou))
 
             model.scheduler_step()  # lr scheduler
+            data_i = target_prefetcher.next()
 
 def validation(model, logger, datasets, device, iters, opt=None):
     # log learning rate for different optimizer
@@ -133,12 +185,18 @@ def validation(model, logger, datasets, device, iters, opt=None):
     
     # validate model
     model.eval(logger=logger)
-    torch.cuda.empty_cache()
+    # empty_cache() synchronizes the device and hands free blocks back to
+    # cudaMalloc, so every later allocation round-trips to the driver; only
+    # pay that cost when the allocator actually holds a lot of unused memory
+    if torch.cuda.is_available() and \
+            torch.cuda.memory_reserved() - torch.cuda.memory_allocated() > 4 * 1024 ** 3:
+        torch.cuda.empty_cache()
     val_datset = datasets.target_valid_loader  #val_datset = datasets.target_train_loader
     running_metrics_val = runningScore(opt.n_class)
-    with torch.no_grad():
+    # inference_mode also skips view tracking and version-counter updates,
+    # shaving per-op CPU overhead compared to no_grad
+    with torch.inference_mode():
         validate(val_datset, device, model, running_metrics_val)
-    torch.cuda.empty_cache()
 
     # log performance
     score, class_iou = running_metrics_val.get_scores()
@@ -148,57 +206,89 @@ def validation(model, logger, datasets, device, iters, opt=None):
     for k, v in class_iou.items():
         logger.info('{}: {}'.format(k, v))
 
-    # save model
+    # save model; state_dict() deep-copies every parameter tensor, so build
+    # the per-net states once and reuse them for the best-model checkpoint
     state = {}
     for _k, net in enumerate(model.nets):
         new_state = {
             "model_state": net.state_dict(),
-            #"optimizer_state": model.optimizers[_k].state_dict(),
-            #"scheduler_state": model.schedulers[_k].state_dict(),  
-            "objective_vectors": model.objective_vectors,
         }
         state[net.__class__.__name__] = new_state
+    # the prototypes are shared by all nets, so store them once at the top
+    # level instead of duplicating the tensor in every per-net entry
+    state['objective_vectors'] = model.objective_vectors
     state['iter'] = iters + 1
     state['best_iou'] = score["Mean IoU : \t"]
+    state = state_to_cpu(state)
     save_path = os.path.join(opt.logdir,"from_{}_to_{}_on_{}_current_model.pkl".\
                                              format(opt.src_dataset, opt.tgt_dataset, opt.model_name))
-    torch.save(state, save_path)
+    _save_pool.submit(torch.save, state, save_path)
 
     if score["Mean IoU : \t"] >= model.best_iou:
-        torch.cuda.empty_cache()
         model.best_iou = score["Mean IoU : \t"]
-        state = {}
+        # shallow-copy the per-net dicts (sharing the already-copied model
+        # tensors) so extending them cannot race the in-flight save above
+        best_state = {k: dict(v) if isinstance(v, dict) else v \
+                        for k, v in state.items()}
         for _k, net in enumerate(model.nets):
-            new_state = {
-                "model_state": net.state_dict(),
-                "optimizer_state": model.optimizers[_k].state_dict(),
-                "scheduler_state": model.schedulers[_k].state_dict(),     
-                "objective_vectors": model.objective_vectors,                
-            }
-            state[net.__class__.__name__] = new_state
-        state['iter'] = iters + 1
-        state['best_iou'] = model.best_iou
+            best_state[net.__class__.__name__]["optimizer_state"] = \
+                    state_to_cpu(model.optimizers[_k].state_dict())
+            best_state[net.__class__.__name__]["scheduler_state"] = \
+                    state_to_cpu(model.schedulers[_k].state_dict())
+        best_state['best_iou'] = model.best_iou
         save_path = os.path.join(opt.logdir,"from_{}_to_{}_on_{}_best_model.pkl".\
                                                 format(opt.src_dataset, opt.tgt_dataset, opt.model_name))
-        torch.save(state, save_path)
-        
+        _save_pool.submit(torch.save, best_state, save_path)
+
     return score["Mean IoU : \t"]
 
 def validate(valid_loader, device, model, running_metrics_val):
+    n_class = running_metrics_val.n_classes
+    # device-resident confusion matrix; only n_class*n_class int64 values
+    # cross PCIe once per validation instead of every prediction map
+    hist = torch.zeros(n_class * n_class, dtype=torch.long, device=device)
+    # reusable per-batch buffers; validation shapes are fixed so these are
+    # allocated once instead of hitting the allocator every iteration
+    max_buf, pred_buf, idx_buf = None, None, None
+
+    # validation runs the same shapes thousands of times, so compile the
+    # eval forward once (cached on the model) and reuse the specialized graph
+    base_forward = model.BaseNet_DP
+    if hasattr(torch, 'compile') and torch.cuda.is_available():
+        if not hasattr(model, '_compiled_base'):
+            model._compiled_base = torch.compile(model.BaseNet_DP, \
+                                        mode='reduce-overhead', dynamic=False)
+        base_forward = model._compiled_base
+
     for data_i in tqdm(valid_loader):
 
-        images_val = data_i['img'].to(device)
-        labels_val = data_i['label'].to(device)
+        images_val = data_i['img'].to(device, non_blocking=True)
+        labels_val = data_i['label'].to(device, non_blocking=True)
 
-        out = model.BaseNet_DP(images_val)
+        with torch.cuda.amp.autocast(enabled=torch.cuda.is_available()):
+            out = base_forward(images_val)
 
-        outputs = F.interpolate(out['out'], size=images_val.size()[2:], \
+        # channels_last routes the memory-bound upsample through cudnn's NHWC
+        # kernel; upcast first so the argmax runs on stable fp32 logits
+        out_cl = out['out'].float().to(memory_format=torch.channels_last)
+        outputs = F.interpolate(out_cl, size=images_val.size()[2:], \
                                 mode='bilinear', align_corners=True)
         #val_loss = loss_fn(input=outputs, target=labels_val)
 
-        pred = outputs.data.max(1)[1].cpu().numpy()
-        gt = labels_val.data.cpu().numpy()
-        running_metrics_val.update(gt, pred)
+        pred_shape = labels_val.shape
+        if pred_buf is None or pred_buf.shape != pred_shape:
+            max_buf = torch.empty(pred_shape, dtype=outputs.dtype, device=device)
+            pred_buf = torch.empty(pred_shape, dtype=torch.long, device=device)
+            idx_buf = torch.empty(pred_shape, dtype=torch.long, device=device)
+        torch.max(outputs, 1, out=(max_buf, pred_buf))
+        valid = (labels_val >= 0) & (labels_val < n_class)
+        torch.mul(labels_val, n_class, out=idx_buf)
+        idx_buf.add_(pred_buf)
+        hist += torch.bincount(idx_buf.view(-1)[valid.view(-1)], \
+                                minlength=n_class * n_class)
+
+    running_metrics_val.update_confusion_matrix(
+        hist.cpu().numpy().reshape(n_class, n_class))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="config")
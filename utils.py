@@ -3,6 +3,7 @@
 
 import logging
 import os
+import shutil
 import datetime
 import numpy as np
 import random
@@ -20,6 +21,21 @@ def get_logger(logdir):
     logger.setLevel(logging.INFO)
     return logger
 
+def stage_to_shm(src_dir):
+    '''copy a directory of small hot files into tmpfs (/dev/shm)
+
+    Pseudo-label files are re-read every epoch; serving them from tmpfs
+    gives in-memory speed without touching the dataset code. Returns the
+    staged path, or src_dir unchanged when tmpfs is unavailable.
+    '''
+    if not os.path.isdir('/dev/shm') or not os.path.isdir(src_dir):
+        return src_dir
+    dst = os.path.join('/dev/shm', 'proda_{}_{}'.format(
+                os.getpid(), os.path.basename(os.path.normpath(src_dir))))
+    if not os.path.exists(dst):
+        shutil.copytree(src_dir, dst)
+    return dst
+
 def fliplr(img):
     '''flip horizontal'''
     inv_idx = torch.arange(img.size(3)-1,-1,-1).long().cuda()  # N x C x H x W